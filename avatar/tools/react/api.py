@@ -1,26 +1,123 @@
 import os
 import os.path as osp
+import asyncio
 import warnings
+import logging
 import json
+import orjson
 import time
+import copy
+import hashlib
+import threading
+import contextlib
+import functools
+import uuid
+import concurrent.futures
+import httpx
 import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer
+import importlib.util
+from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
+from tenacity import Retrying, stop_after_attempt, wait_random_exponential, retry_if_exception_type
 
 import anthropic
 import openai
+from avatar.utils.json_parse import extract_json, stream_text
+from avatar.utils.key_pool import KeyPool
+from avatar.utils.rate_limiter import RateLimiter
 try:
     import google.generativeai as genai
+    from google.api_core import exceptions as google_exceptions
 except ImportError:
     genai = None
-MAX_OPENAI_RETRY, OPENAI_SLEEP_TIME = 5, 60
-MAX_CLAUDE_RETRY, CLAUDE_SLEEP_TIME = 100, 5
-MAX_GEMINI_RETRY, GEMINI_SLEEP_TIME = 5, 30
+    google_exceptions = None
+try:
+    from vllm import AsyncEngineArgs, AsyncLLMEngine, SamplingParams
+except ImportError:
+    AsyncLLMEngine = None
+MAX_OPENAI_RETRY = 5
+MAX_CLAUDE_RETRY = 10
+MAX_GEMINI_RETRY = 5
+# Per-request timeouts in seconds; a hung call counts as a failed attempt.
+# Read timeouts grow with max_tokens, since a long completion is not returned
+# until it has been fully generated.
+OPENAI_TIMEOUT = 30
+CLAUDE_TIMEOUT = 60
+TIMEOUT_PER_TOKEN = 0.1
+GEMINI_TIMEOUT = 45
+RETRY_MIN_WAIT, RETRY_MAX_WAIT = 1, 60
+LLM_BATCH_CONCURRENCY = int(os.getenv("LLM_BATCH_CONCURRENCY", 16))
+
+# Connection pool shared by the provider clients so keep-alive connections are
+# reused across calls instead of being re-established per request.
+HTTP_MAX_KEEPALIVE, HTTP_MAX_CONNECTIONS = 32, 64
+HTTP_CONNECT_TIMEOUT = 10.0
+# Several API keys may be given as a comma-separated list (OPENAI_API_KEYS,
+# ANTHROPIC_API_KEYS, GEMINI_API_KEYS); requests rotate through them and a key
+# that hits a rate limit is skipped for KEY_QUARANTINE_TIME seconds.
+KEY_QUARANTINE_TIME = 60
+_openai_pool = None
+_anthropic_pool = None
+_genai_configured = False
+_gemini_pools = {}
+# Last OpenAI Responses API response id per conversation thread
+_openai_sessions = {}
+_client_lock = threading.Lock()
+
+# Anthropic prompt caching: the system prompt, tool schemas and conversation
+# history are marked as cacheable prefixes. Disable with CLAUDE_PROMPT_CACHE=0.
+CLAUDE_PROMPT_CACHE = os.getenv("CLAUDE_PROMPT_CACHE", "1") == "1"
+CLAUDE_BETA_HEADERS = "tools-2024-05-16,prompt-caching-2024-07-31"
+JSON_INSTRUCTION = "You are a helpful assistant designed to output in JSON format."
+
+logger = logging.getLogger(__name__)
+
+# Client-side (requests per minute, tokens per minute) budgets per API key,
+# matched by model name prefix, so calls pace themselves instead of running into 429s.
+# Set AVATAR_RATE_LIMIT=0 to disable.
+RATE_LIMIT_ENABLED = os.getenv("AVATAR_RATE_LIMIT", "1") == "1"
+RATE_LIMITS = {
+    "gpt-4-turbo": (10000, 800_000),
+    "gpt-4": (10000, 300_000),
+    "claude-3-opus": (4000, 400_000),
+    "claude-3-sonnet": (4000, 400_000),
+    "claude-3-haiku": (4000, 400_000),
+    "claude-2": (4000, 400_000),
+    "gemini-1.5-pro": (1000, 4_000_000),
+    "gemini-1.5-flash": (2000, 4_000_000),
+    "gemma": (30, 15_000),
+}
+_rate_limiters = {}
+
+# Transient failures (rate limits, connection problems, 5xx) are retried with
+# exponential backoff; anything else (bad request, auth, ...) fails fast.
+OPENAI_RETRY_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+CLAUDE_RETRY_ERRORS = (anthropic.RateLimitError, anthropic.APIConnectionError, anthropic.InternalServerError)
+GEMINI_RETRY_ERRORS = () if google_exceptions is None else (
+    google_exceptions.ResourceExhausted, google_exceptions.ServiceUnavailable,
+    google_exceptions.InternalServerError, google_exceptions.DeadlineExceeded, concurrent.futures.TimeoutError)
+GEMINI_RATE_LIMIT_ERRORS = () if google_exceptions is None else (google_exceptions.ResourceExhausted,)
+
+# Exact-match response cache, enabled with AVATAR_LLM_CACHE=1. Entries expire
+# after AVATAR_LLM_CACHE_TTL seconds (0 means never).
+LLM_CACHE_ENABLED = os.getenv("AVATAR_LLM_CACHE", "0") == "1"
+LLM_CACHE_TTL = float(os.getenv("AVATAR_LLM_CACHE_TTL", 0))
+_response_cache = {}
 
-registered_text_completion_llms = {
+# Semantic cache for paraphrased prompts, enabled with AVATAR_SEMANTIC_CACHE=1.
+# Only deterministic (temperature == 0) completions are stored.
+SEMANTIC_CACHE_ENABLED = os.getenv("AVATAR_SEMANTIC_CACHE", "0") == "1"
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("AVATAR_SEMANTIC_THRESHOLD", 0.92))
+SEMANTIC_CACHE_MODEL = os.getenv("AVATAR_SEMANTIC_MODEL", "all-MiniLM-L6-v2")
+_semantic_cache = None
+
+# Identical deterministic requests issued concurrently share one provider call
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+registered_text_completion_llms = frozenset({
     "gpt-4-1106-preview",
     "gpt-4-0125-preview", "gpt-4-turbo-preview",
-    "gpt-4-turbo", "gpt-4-turbo-2024-04-09"
-    "gpt-4-turbo",
+    "gpt-4-turbo", "gpt-4-turbo-2024-04-09",
     "claude-2.1",
     "claude-3-opus-20240229", 
     "claude-3-sonnet-20240229", 
@@ -30,18 +127,168 @@ registered_text_completion_llms = {
     "gemma-2-9b-it",
     "gemini-1.5-flash",
     "gemini-1.5-pro"
-}
+})
+# Guard against adjacent string literals being silently concatenated
+assert all(isinstance(m, str) and " " not in m and m.count("gpt-") <= 1 
+           for m in registered_text_completion_llms)
+
+def _log_retry(retry_state):
+    print(retry_state.attempt_number, "=>", retry_state.outcome.exception(),
+          f' [sleep for {retry_state.next_action.sleep:.1f} sec]')
+
+def _retrying(max_retry, retry_errors):
+    """Build a tenacity retry loop with jittered exponential backoff."""
+    return Retrying(stop=stop_after_attempt(max_retry),
+                    wait=wait_random_exponential(min=RETRY_MIN_WAIT, max=RETRY_MAX_WAIT),
+                    retry=retry_if_exception_type(retry_errors),
+                    before_sleep=_log_retry,
+                    reraise=True)
+
+def _rate_limit(model, messages, api_key):
+    """
+    Wait for the rate-limit budget of `model` under `api_key`; each key is a
+    separate account with its own budget. Only the prompt is counted (~4
+    characters per token): reserving max_tokens as well would throttle small
+    TPM budgets far below their RPM limit.
+    """
+    if not RATE_LIMIT_ENABLED:
+        return
+    prefix = max((p for p in RATE_LIMITS if model.startswith(p)), key=len, default=None)
+    if prefix is None:
+        return
+    with _client_lock:
+        if (prefix, api_key) not in _rate_limiters:
+            _rate_limiters[(prefix, api_key)] = RateLimiter(*RATE_LIMITS[prefix])
+    _rate_limiters[(prefix, api_key)].acquire(len(str(messages)) // 4)
+
+@contextlib.contextmanager
+def _rotate_on_rate_limit(pool, rate_limit_errors):
+    """Take the next item from `pool`, quarantining it if the call is rate limited."""
+    item = pool.next()
+    try:
+        yield item
+    except rate_limit_errors:
+        pool.quarantine(item, KEY_QUARANTINE_TIME)
+        raise
+
+def _timeout(base, max_tokens=0):
+    return httpx.Timeout(base + max_tokens * TIMEOUT_PER_TOKEN, connect=HTTP_CONNECT_TIMEOUT)
+
+def _http_client(timeout):
+    return httpx.Client(limits=httpx.Limits(max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                                            max_connections=HTTP_MAX_CONNECTIONS),
+                        timeout=timeout)
+
+def _api_keys(name):
+    """Read the keys from `<name>S` (comma-separated), falling back to `<name>`."""
+    keys = [key.strip() for key in os.environ.get(name + "S", "").split(",") if key.strip()]
+    return keys or [os.environ.get(name)]
+
+def _openai_clients():
+    global _openai_pool
+    if _openai_pool is None:
+        with _client_lock:
+            if _openai_pool is None:
+                # Retries are handled by tenacity, not the SDK
+                _openai_pool = KeyPool([openai.OpenAI(api_key=key,
+                                                      http_client=_http_client(_timeout(OPENAI_TIMEOUT)),
+                                                      timeout=_timeout(OPENAI_TIMEOUT),
+                                                      max_retries=0)
+                                        for key in _api_keys("OPENAI_API_KEY")])
+    return _openai_pool
+
+def _anthropic_clients():
+    global _anthropic_pool
+    if _anthropic_pool is None:
+        with _client_lock:
+            if _anthropic_pool is None:
+                _anthropic_pool = KeyPool([anthropic.Anthropic(api_key=key,
+                                                               http_client=_http_client(_timeout(CLAUDE_TIMEOUT)),
+                                                               timeout=_timeout(CLAUDE_TIMEOUT),
+                                                               max_retries=0)
+                                           for key in _api_keys("ANTHROPIC_API_KEY")])
+    return _anthropic_pool
+
+def get_openai_client():
+    """Return the next pooled OpenAI client, creating the pool on first use."""
+    return _openai_clients().next()
+
+def get_anthropic_client():
+    """Return the next pooled Anthropic client, creating the pool on first use."""
+    return _anthropic_clients().next()
+
+def _prompt_cache_key(messages):
+    """Derive a routing key for OpenAI prompt caching from the first (stable) message."""
+    return "avatar-" + hashlib.sha256(str(messages[0]["content"]).encode()).hexdigest()[:16]
+
+def _gemini_models(model):
+    global _genai_configured
+    if model in _gemini_pools:
+        return _gemini_pools[model]
+    with _client_lock:
+        if model in _gemini_pools:
+            return _gemini_pools[model]
+        if genai is None:
+            raise ImportError("google-generativeai package not installed. Please install it with: pip install google-generativeai")
+        api_keys = [key for key in _api_keys("GEMINI_API_KEY") if key]
+        if not api_keys:
+            raise ValueError("GEMINI_API_KEY environment variable not found.")
+        if len(api_keys) == 1:
+            if not _genai_configured:
+                genai.configure(api_key=api_keys[0])
+                _genai_configured = True
+            models = [(api_keys[0], genai.GenerativeModel(model))]
+        else:
+            # genai.configure is process-global and GenerativeModel takes no API
+            # key, so each key's service client is attached through the private
+            # `_client` attribute (present in google-generativeai 0.8.x, as pinned
+            # in requirements.txt)
+            from google.ai import generativelanguage as glm
+            models = []
+            for key in api_keys:
+                gemini_model = genai.GenerativeModel(model)
+                if not hasattr(gemini_model, "_client"):
+                    raise RuntimeError("Multiple GEMINI_API_KEYS are not supported by this google-generativeai "
+                                       "version (GenerativeModel has no `_client`); use a single GEMINI_API_KEY.")
+                gemini_model._client = glm.GenerativeServiceClient(client_options={"api_key": key})
+                models.append((key, gemini_model))
+        _gemini_pools[model] = KeyPool(models)
+    return _gemini_pools[model]
+
+def get_gemini_model(model):
+    """
+    Return a cached `GenerativeModel` for `model`, rotating through the
+    configured Gemini API keys.
+    """
+    return _gemini_models(model).next()[1]
 
 def get_gpt_output(message, 
                    model="gpt-4-1106-preview", 
                    max_tokens=2048, 
                    temperature=1, 
                    max_retry=5,
-                   sleep_time=60,
                    json_object=False,
                    history=None,
                    tools=[],
-                   return_raw=False):
+                   return_raw=False,
+                   seed=None,
+                   thread_id=None,
+                   previous_response_id=None,
+                   stream=False):
+    """
+    Call the OpenAI API to complete a prompt.
+
+    With `stream=True`, plain completions are returned as a generator of text
+    deltas; in JSON mode the response is read until the first complete JSON
+    object, which is parsed and returned while the rest of the generation is
+    cancelled. Streaming is only supported for chat completions, so combining
+    it with `thread_id` or `previous_response_id` raises a ValueError.
+
+    If `thread_id` or `previous_response_id` is given, the request goes through
+    the Responses API (openai>=1.66): the conversation state is kept server-side,
+    so `history` is not resent, and the id of each response is remembered per
+    `thread_id` to chain the next turn.
+    """
     if json_object:
         if isinstance(message, str) and not 'json' in message.lower():
             message = 'You are a helpful assistant designed to output JSON. ' + message
@@ -50,35 +297,74 @@ def get_gpt_output(message,
         messages = [{"role": "user", "content": message}] 
     else:
         messages = message
-    if history:
-        messages = history + messages
-    kwargs = {"response_format": { "type": "json_object" }} if json_object else {}
 
-    for cnt in range(max_retry):
-        try:
-            chat = openai.OpenAI().chat.completions.create(
-                messages=messages,
-                model=model,
-                temperature=temperature,
-                max_tokens=max_tokens,
-                **kwargs
-                )
-            result = chat.choices[0].message.content 
-        except Exception as e:
-            error = e
-            print(cnt, "=>", e, f' [sleep for {sleep_time} sec]')
-            time.sleep(sleep_time)
-            continue
-            
-        try:
-            if json_object:
-                result = result[result.find("{"):result.rfind("}")+1]
-                return json.loads(result)
-            return result
-        except Exception as e:
-            print(result)
-            print(cnt, "=> (json encode error) ", e)
-    raise error
+    if previous_response_id is None and thread_id is not None:
+        previous_response_id = _openai_sessions.get(thread_id)
+    if thread_id is not None or previous_response_id is not None:
+        if stream:
+            raise ValueError("stream=True is not supported with thread_id/previous_response_id.")
+        # Inspect a pooled client without advancing the key rotation
+        if not hasattr(_openai_clients().items[0], "responses"):
+            raise ImportError("The Responses API requires openai>=1.66. Please upgrade it with: pip install -U openai")
+        if previous_response_id is None and history:
+            messages = history + messages
+        kwargs = {"text": {"format": {"type": "json_object"}}} if json_object else {}
+        for attempt in _retrying(max_retry, OPENAI_RETRY_ERRORS):
+            with attempt, _rotate_on_rate_limit(_openai_clients(), openai.RateLimitError) as client:
+                _rate_limit(model, messages, client.api_key)
+                response = client.responses.create(
+                    input=messages,
+                    model=model,
+                    temperature=temperature,
+                    max_output_tokens=max_tokens,
+                    timeout=_timeout(OPENAI_TIMEOUT, max_tokens),
+                    previous_response_id=previous_response_id,
+                    # Sent raw: only recent SDK releases accept it as a named argument
+                    extra_body={"prompt_cache_key": _prompt_cache_key(history or messages)},
+                    **kwargs
+                    )
+        if thread_id is not None:
+            _openai_sessions[thread_id] = response.id
+        logger.info(f"{model} usage: input={response.usage.input_tokens}, output={response.usage.output_tokens}")
+        result = response.output_text
+    else:
+        if history:
+            messages = history + messages
+        kwargs = {"response_format": { "type": "json_object" }} if json_object else {}
+        if seed is not None:
+            kwargs["seed"] = seed
+        for attempt in _retrying(max_retry, OPENAI_RETRY_ERRORS):
+            with attempt, _rotate_on_rate_limit(_openai_clients(), openai.RateLimitError) as client:
+                _rate_limit(model, messages, client.api_key)
+                chat = client.chat.completions.create(
+                    messages=messages,
+                    model=model,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    timeout=_timeout(OPENAI_TIMEOUT, max_tokens),
+                    extra_body={"prompt_cache_key": _prompt_cache_key(messages)},
+                    stream=stream,
+                    **kwargs
+                    )
+        if stream:
+            chunks = (chunk.choices[0].delta.content or "" for chunk in chat if chunk.choices)
+            return stream_text(chunks, json_object, chat.close)
+        logger.info(f"{model} usage: input={chat.usage.prompt_tokens}, output={chat.usage.completion_tokens}")
+        result = chat.choices[0].message.content 
+
+    # Parse errors are deterministic, so they are raised instead of retried
+    if json_object:
+        return extract_json(result)
+    return result
+
+def _cache_control(content):
+    """Return `content` as a list of blocks with a cache breakpoint on the last one."""
+    if isinstance(content, str):
+        content = [{"type": "text", "text": content}]
+    else:
+        content = [dict(block) for block in content]
+    content[-1]["cache_control"] = {"type": "ephemeral"}
+    return content
 
 def complete_text_claude(message, 
                          model="claude-2.1",
@@ -86,56 +372,104 @@ def complete_text_claude(message,
                          max_tokens=2048, 
                          temperature=1, 
                          max_retry=1,
-                         sleep_time=0,
                          tools=[],
                          history=None,
                          return_raw=False,
+                         system=None,
                          **kwargs
                          ):
-    try:   
-        api_key = os.environ.get("ANTHROPIC_API_KEY")
-        anthropic_client = anthropic.Anthropic(api_key=api_key)
-    except Exception as e:
-        print(e)
-        print("Anthropic API key not found.")
-    """ Call the Claude API to complete a prompt."""
+    """ Call the Claude API to complete a prompt.
+
+    `system` (str or list of blocks) is sent as the system prompt. For Claude 3
+    models the system prompt, the tool schemas and the end of `history` are
+    marked with `cache_control` so that stable prefixes are read from
+    Anthropic's prompt cache on subsequent calls.
+    """
+    if json_object and isinstance(message, str):
+        # Keep the instruction in the (cacheable) system prompt instead of the message
+        if system is None:
+            system = JSON_INSTRUCTION
+        elif isinstance(system, str):
+            system = JSON_INSTRUCTION + " " + system
+        else:
+            system = [{"type": "text", "text": JSON_INSTRUCTION}] + list(system)
     if isinstance(message, str):
-        if json_object:
-            message = "You are a helpful assistant designed to output in JSON format." + message
         messages = [{"role": "user", "content": message}]
     else:
         messages = message
-    
-    if history is not None:
+
+    prompt_cache = CLAUDE_PROMPT_CACHE and model.startswith("claude-3")
+    if history:
+        if prompt_cache:
+            history = history[:-1] + [{**history[-1], "content": _cache_control(history[-1]["content"])}]
         messages = history + messages
+    if system is not None:
+        kwargs["system"] = _cache_control(system) if prompt_cache else system
+    if prompt_cache:
+        if tools:
+            tools = tools[:-1] + [{**tools[-1], "cache_control": {"type": "ephemeral"}}]
+        kwargs["extra_headers"] = {"anthropic-beta": CLAUDE_BETA_HEADERS, **kwargs.get("extra_headers", {})}
 
-    result = None
-    e = None
-    for cnt in range(max_retry):
-        try:
+    for attempt in _retrying(max_retry, CLAUDE_RETRY_ERRORS):
+        with attempt, _rotate_on_rate_limit(_anthropic_clients(), anthropic.RateLimitError) as anthropic_client:
+            _rate_limit(model, messages, anthropic_client.api_key)
             result = anthropic_client.beta.tools.messages.create(
                 messages=messages,
                 model=model,
                 temperature=temperature,
                 max_tokens=max_tokens,
                 tools=tools,
+                timeout=_timeout(CLAUDE_TIMEOUT, max_tokens),
                 **kwargs
             )
-            if not return_raw:
-                result = result.to_dict()["content"][0]['text']
-        except Exception as e:
-            print(cnt, "=>", e, f' [sleep for {sleep_time} sec]')
-            time.sleep(sleep_time)
+    usage = result.usage
+    logger.info(f"{model} usage: input={usage.input_tokens}, output={usage.output_tokens}, "
+                f"cache_read={getattr(usage, 'cache_read_input_tokens', None)}, "
+                f"cache_creation={getattr(usage, 'cache_creation_input_tokens', None)}")
+    if return_raw:
+        return result
+    result = result.to_dict()["content"][0]['text']
+    if json_object:
+        return extract_json(result)
+    return result
+
+def _gemini_stream_text(response):
+    for chunk in response:
+        try:
+            yield chunk.text
+        except ValueError:
+            # Chunks without text parts (e.g. the final or a safety chunk)
             continue
-        
+
+def _run_with_timeout(timeout, fn, *args, **kwargs):
+    """
+    Run `fn` in its own thread and wait at most `timeout` seconds for it.
+
+    Each call gets a dedicated thread, so Gemini concurrency is bounded only by
+    the caller (e.g. the batch `concurrency`). A call that times out cannot be
+    interrupted; it is abandoned and its thread ends when the RPC deadline
+    passed in `request_options` expires.
+    """
+    future = concurrent.futures.Future()
+
+    def _call():
         try:
-            if json_object and not return_raw:
-                return json.loads(result)
-            return result
-        except Exception as e:
-            print(result)
-            print(cnt, "=> (json encode error) ", e)
-    raise e
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=_call, daemon=True).start()
+    return future.result(timeout=timeout)
+
+GEMINI_ROLES = {"user": "user", "assistant": "model"}
+
+def _to_gemini_messages(messages):
+    """Convert OpenAI-style messages to Gemini's format; other roles are dropped."""
+    if not messages or "parts" in messages[0]:
+        # Already in Gemini format
+        return list(messages)
+    return [{"role": GEMINI_ROLES[msg["role"]], "parts": [msg["content"]]} 
+            for msg in messages if msg["role"] in GEMINI_ROLES]
 
 def complete_text_gemini(message, 
                         model="gemma-3-27b-it",
@@ -143,105 +477,215 @@ def complete_text_gemini(message,
                         max_tokens=2048, 
                         temperature=1, 
                         max_retry=5,
-                        sleep_time=30,
                         tools=[],
                         history=None,
                         return_raw=False,
+                        stream=False,
                         **kwargs
                         ):
-    """Call the Gemini API to complete a prompt."""
-    try:   
-        api_key = os.environ.get("GEMINI_API_KEY")
-        if not api_key:
-            raise ValueError("GEMINI_API_KEY environment variable not found.")
-        if genai is None:
-            raise ImportError("google-generativeai package not installed. Please install it with: pip install google-generativeai")
-        
-        genai.configure(api_key=api_key)
-    except Exception as e:
-        print(e)
-        print("Gemini API setup failed.")
-        raise e
-    
-    # Convert message format
+    """Call the Gemini API to complete a prompt.
+
+    With `stream=True`, plain completions are returned as a generator of text
+    chunks; in JSON mode the response is read only until the first complete
+    JSON object. The SDK offers no way to cancel a stream, so the server may
+    still finish generating. Streaming is ignored when `return_raw` is set.
+    """
+    gemini_models = _gemini_models(model)
+    # Gemini models enforce JSON natively (a `response_schema` may be passed
+    # through kwargs); Gemma models do not support it and keep the instruction
+    native_json = json_object and not return_raw and not model.startswith("gemma")
+    if native_json:
+        kwargs.setdefault("response_mime_type", "application/json")
+    generation_config = genai.types.GenerationConfig(
+        max_output_tokens=max_tokens,
+        temperature=temperature,
+        **kwargs
+    )
+
     if isinstance(message, str):
-        if json_object:
-            message = "You are a helpful assistant designed to output in JSON format. " + message
-        messages = [{"role": "user", "parts": [message]}]
-    else:
-        messages = []
-        for msg in message:
-            if msg["role"] == "user":
-                messages.append({"role": "user", "parts": [msg["content"]]})
-            elif msg["role"] == "assistant":
-                messages.append({"role": "model", "parts": [msg["content"]]})
-    
-    if history is not None:
-        # Convert history to Gemini format
-        converted_history = []
-        for msg in history:
-            if msg["role"] == "user":
-                converted_history.append({"role": "user", "parts": [msg["content"]]})
-            elif msg["role"] == "assistant":
-                converted_history.append({"role": "model", "parts": [msg["content"]]})
-        messages = converted_history + messages
-
-    result = None
-    e = None
-    for cnt in range(max_retry):
-        try:
-            # Initialize the model
-            if model.startswith("gemma"):
-                # Use Gemma model
-                gemini_model = genai.GenerativeModel(model)
-                generation_config = genai.types.GenerationConfig(
-                    max_output_tokens=max_tokens,
-                    temperature=temperature,
-                    **kwargs
-                )
-            else:
-                # Use Gemini model
-                gemini_model = genai.GenerativeModel(model) 
-                generation_config = genai.types.GenerationConfig(
-                    max_output_tokens=max_tokens,
-                    temperature=temperature,
-                    **kwargs
-                )
-            
+        if json_object and not native_json:
+            message = JSON_INSTRUCTION + " " + message
+        message = [{"role": "user", "parts": [message]}]
+    messages = _to_gemini_messages(history or []) + _to_gemini_messages(message)
+
+    stream = stream and not return_raw
+    timeout = GEMINI_TIMEOUT + max_tokens * TIMEOUT_PER_TOKEN
+    for attempt in _retrying(max_retry, GEMINI_RETRY_ERRORS):
+        with attempt, _rotate_on_rate_limit(gemini_models, GEMINI_RATE_LIMIT_ERRORS) as (gemini_key, gemini_model):
+            _rate_limit(model, messages, gemini_key)
             # For single message (most common case)
             if len(messages) == 1:
-                response = gemini_model.generate_content(
+                response = _run_with_timeout(
+                    timeout,
+                    gemini_model.generate_content,
                     messages[0]["parts"][0],
-                    generation_config=generation_config
+                    generation_config=generation_config,
+                    stream=stream,
+                    request_options={"timeout": timeout}
                 )
             else:
                 # For conversation with history
                 chat = gemini_model.start_chat(history=messages[:-1])
-                response = chat.send_message(
+                response = _run_with_timeout(
+                    timeout,
+                    chat.send_message,
                     messages[-1]["parts"][0],
-                    generation_config=generation_config
+                    generation_config=generation_config,
+                    stream=stream,
+                    request_options={"timeout": timeout}
                 )
-            
-            if return_raw:
-                result = response
-            else:
-                result = response.text
-                
-        except Exception as e:
-            print(cnt, "=>", e, f' [sleep for {sleep_time} sec]')
-            time.sleep(sleep_time)
-            continue
-        
+
+    if stream:
+        chunks = _gemini_stream_text(response)
+        return stream_text(chunks, json_object, chunks.close)
+    usage = response.usage_metadata
+    logger.info(f"{model} usage: input={usage.prompt_token_count}, output={usage.candidates_token_count}")
+
+    if return_raw:
+        return response
+    result = response.text
+    if native_json:
+        # The body is JSON by contract, so no extraction step is needed
+        return orjson.loads(result)
+    if json_object:
+        return extract_json(result)
+    return result
+
+loaded_hf_models = {}
+HF_BATCH_SIZE = int(os.getenv("HF_BATCH_SIZE", 8))
+# HuggingFace models are served with vLLM (continuous batching, prefix caching)
+# when it is installed; set HF_BACKEND=transformers to use `generate` instead.
+HF_BACKEND = os.getenv("HF_BACKEND", "transformers" if AsyncLLMEngine is None else "vllm")
+VLLM_MAX_MODEL_LEN = int(os.getenv("VLLM_MAX_MODEL_LEN", 8192))
+# Weight quantization for the transformers backend: "4bit", "8bit" or "none".
+# Requires bitsandbytes and a CUDA device; otherwise models load unquantized.
+HF_QUANTIZATION = os.getenv("HF_QUANTIZATION", "4bit")
+_vllm_loop = None
+
+def _from_pretrained_quantized(model):
+    """Load `model` with 4-bit (falling back to 8-bit) bitsandbytes quantization."""
+    quant_cfgs = {
+        "4bit": BitsAndBytesConfig(load_in_4bit=True, 
+                                   bnb_4bit_compute_dtype=torch.bfloat16, 
+                                   bnb_4bit_quant_type="nf4"),
+        "8bit": BitsAndBytesConfig(load_in_8bit=True),
+    }
+    modes = ["4bit", "8bit"] if HF_QUANTIZATION == "4bit" else ["8bit"]
+    for mode in modes:
         try:
-            if json_object and not return_raw:
-                return json.loads(result)
-            return result
+            return AutoModelForCausalLM.from_pretrained(model, 
+                                                        quantization_config=quant_cfgs[mode], 
+                                                        torch_dtype=torch.bfloat16,
+                                                        device_map="auto")
         except Exception as e:
-            print(result)
-            print(cnt, "=> (json encode error) ", e)
-    raise e
+            error = e
+            print(f"{mode} quantization failed for {model} =>", e)
+    raise error
 
-loaded_hf_models = {}
+def _load_hf_model(model):
+    model = model.split("/", 1)[1]
+    if model in loaded_hf_models:
+        hf_model, tokenizer = loaded_hf_models[model]
+    else:
+        if (HF_QUANTIZATION in ("4bit", "8bit") and torch.cuda.is_available() 
+                and importlib.util.find_spec("bitsandbytes") is not None):
+            hf_model = _from_pretrained_quantized(model)
+        else:
+            device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+            dtype = torch.bfloat16 if torch.cuda.is_available() else torch.float32
+            hf_model = AutoModelForCausalLM.from_pretrained(model, torch_dtype=dtype).to(device)
+        tokenizer = AutoTokenizer.from_pretrained(model)
+        # Left padding keeps every prompt adjacent to its generated tokens
+        tokenizer.padding_side = "left"
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+        loaded_hf_models[model] = (hf_model, tokenizer)
+    return hf_model, tokenizer, hf_model.device
+
+def _get_vllm_loop():
+    """Return the event loop that drives the vLLM engines, started in a daemon thread."""
+    global _vllm_loop
+    with _client_lock:
+        if _vllm_loop is None:
+            _vllm_loop = asyncio.new_event_loop()
+            threading.Thread(target=_vllm_loop.run_forever, daemon=True).start()
+    return _vllm_loop
+
+async def _load_vllm_engine(model):
+    key = "vllm/" + model.split("/", 1)[1]
+    if key not in loaded_hf_models:
+        engine_args = AsyncEngineArgs(model=model.split("/", 1)[1], 
+                                      enable_prefix_caching=True, 
+                                      max_model_len=VLLM_MAX_MODEL_LEN)
+        loaded_hf_models[key] = AsyncLLMEngine.from_engine_args(engine_args)
+    return loaded_hf_models[key]
+
+async def _vllm_generate(model, messages, sampling_params):
+    engine = await _load_vllm_engine(model)
+
+    async def _generate(prompt):
+        final_output = None
+        async for request_output in engine.generate(prompt, sampling_params, request_id=str(uuid.uuid4())):
+            final_output = request_output
+        return final_output.outputs[0].text
+
+    return await asyncio.gather(*(_generate(prompt) for prompt in messages))
+
+def batch_complete_text_hf(messages, 
+                           model="huggingface/codellama/CodeLlama-7b-hf", 
+                           max_tokens=2000, 
+                           temperature=0.5, 
+                           json_object=False,
+                           batch_size=HF_BATCH_SIZE,
+                           stop_sequences=[],
+                           **kwargs):
+    """
+    Complete a list of prompts with a HuggingFace model; completions are returned
+    in the order of `messages`.
+
+    With the vLLM backend all prompts are submitted to the engine at once and
+    scheduled with continuous batching. With the transformers backend prompts
+    are bucketed by length and `batch_size` of them are generated per call.
+    """
+    if json_object:
+        messages = [JSON_INSTRUCTION + message for message in messages]
+    if HF_BACKEND == "vllm":
+        if AsyncLLMEngine is None:
+            raise ImportError("vllm package not installed. Please install it with: pip install vllm, "
+                              "or set HF_BACKEND=transformers")
+        sampling_params = SamplingParams(temperature=temperature, 
+                                         max_tokens=max_tokens, 
+                                         stop=stop_sequences or None,
+                                         **kwargs)
+        future = asyncio.run_coroutine_threadsafe(_vllm_generate(model, messages, sampling_params),
+                                                  _get_vllm_loop())
+        return future.result()
+
+    hf_model, tokenizer, device = _load_hf_model(model)
+
+    lengths = [len(ids) for ids in tokenizer(messages, return_token_type_ids=False).input_ids]
+    order = sorted(range(len(messages)), key=lambda i: lengths[i])
+    completions = [None] * len(messages)
+    for start in range(0, len(order), batch_size):
+        indices = order[start:start + batch_size]
+        encoded_input = tokenizer([messages[i] for i in indices], 
+                                  padding=True,
+                                  return_tensors="pt", 
+                                  return_token_type_ids=False
+                                  ).to(device)
+        output = hf_model.generate(
+            **encoded_input,
+            temperature=temperature,
+            max_new_tokens=max_tokens,
+            do_sample=True,
+            pad_token_id=tokenizer.pad_token_id,
+            return_dict_in_generate=True,
+            **kwargs,
+        )
+        sequences = output.sequences[:, encoded_input.input_ids.shape[1]:]
+        for i, text in zip(indices, tokenizer.batch_decode(sequences, skip_special_tokens=True)):
+            completions[i] = text
+    return completions
 
 def complete_text_hf(message, 
                      model="huggingface/codellama/CodeLlama-7b-hf", 
@@ -251,42 +695,118 @@ def complete_text_hf(message,
                      max_retry=1,
                      sleep_time=0,
                      stop_sequences=[], 
+                     history=None,
+                     tools=[],
+                     return_raw=False,
                      **kwargs):
-    if json_object:
-        message = "You are a helpful assistant designed to output in JSON format." + message
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    model = model.split("/", 1)[1]
-    if model in loaded_hf_models:
-        hf_model, tokenizer = loaded_hf_models[model]
-    else:
-        hf_model = AutoModelForCausalLM.from_pretrained(model).to(device)
-        tokenizer = AutoTokenizer.from_pretrained(model)
-        loaded_hf_models[model] = (hf_model, tokenizer)
-        
-    encoded_input = tokenizer(message, 
-                              return_tensors="pt", 
-                              return_token_type_ids=False
-                              ).to(device)
     for cnt in range(max_retry):
         try:
-            output = hf_model.generate(
-                **encoded_input,
-                temperature=temperature,
-                max_new_tokens=max_tokens,
-                do_sample=True,
-                return_dict_in_generate=True,
-                output_scores=True,
-                **kwargs,
-            )
-            sequences = output.sequences
-            sequences = [sequence[len(encoded_input.input_ids[0]) :] for sequence in sequences]
-            all_decoded_text = tokenizer.batch_decode(sequences)
-            completion = all_decoded_text[0]
-            return completion
+            return batch_complete_text_hf([message],
+                                          model=model,
+                                          max_tokens=max_tokens,
+                                          temperature=temperature,
+                                          json_object=json_object,
+                                          stop_sequences=stop_sequences,
+                                          **kwargs)[0]
         except Exception as e:
+            error = e
             print(cnt, "=>", e)
             time.sleep(sleep_time)
-    raise e
+    raise error
+
+def _cache_key(**kwargs):
+    """Hash the request arguments into a stable cache key."""
+    payload = json.dumps(kwargs, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def _cache_lookup(key):
+    entry = _response_cache.get(key)
+    if entry is None:
+        return None
+    timestamp, value = entry
+    if LLM_CACHE_TTL > 0 and time.time() - timestamp > LLM_CACHE_TTL:
+        _response_cache.pop(key, None)
+        return None
+    # Hand out a copy so callers mutating the result do not corrupt the cache
+    return copy.deepcopy(value)
+
+def _cache_update(key, value):
+    _response_cache[key] = (time.time(), copy.deepcopy(value))
+
+def _get_semantic_cache():
+    global _semantic_cache
+    if _semantic_cache is None:
+        from avatar.utils.semantic_cache import SemanticCache
+        _semantic_cache = SemanticCache(SEMANTIC_CACHE_MODEL, threshold=SEMANTIC_CACHE_THRESHOLD)
+    return _semantic_cache
+
+def _semantic_prompt(message, history=None):
+    """
+    Return the text to embed for the semantic cache, or None if the request is
+    not eligible. Only single-turn prompts are eligible: with history or several
+    messages, the part that differs between requests may be truncated away by
+    the encoder and unrelated conversations would match.
+    """
+    if history:
+        return None
+    if isinstance(message, str):
+        return message
+    if len(message) != 1:
+        return None
+    msg = message[0]
+    content = msg["parts"] if "parts" in msg else msg.get("content")
+    if isinstance(content, list):
+        content = "\n".join(str(part) for part in content)
+    return content if isinstance(content, str) else None
+
+class _Flight:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+def _single_flight(key, fn):
+    """
+    Run `fn` once per `key` among concurrent callers: the first caller makes the
+    call, later callers with the same key wait for and share its outcome.
+    """
+    with _inflight_lock:
+        flight = _inflight.get(key)
+        leader = flight is None
+        if leader:
+            flight = _inflight[key] = _Flight()
+    if not leader:
+        flight.event.wait()
+        if flight.error is not None:
+            raise flight.error
+        return copy.deepcopy(flight.result)
+    try:
+        result = fn()
+        # Followers copy from a private snapshot, so the leader may mutate its result
+        flight.result = copy.deepcopy(result)
+        return result
+    except Exception as e:
+        flight.error = e
+        raise
+    finally:
+        with _inflight_lock:
+            _inflight.pop(key, None)
+        flight.event.set()
+
+def clear_llm_cache():
+    _response_cache.clear()
+    if _semantic_cache is not None:
+        _semantic_cache.clear()
+
+# Model name prefix -> (completion function, max_retry)
+PROVIDER_TABLE = (
+    ("gpt-", (get_gpt_output, MAX_OPENAI_RETRY)),
+    ("claude-", (complete_text_claude, MAX_CLAUDE_RETRY)),
+    ("gemma", (complete_text_gemini, MAX_GEMINI_RETRY)),
+    ("gemini", (complete_text_gemini, MAX_GEMINI_RETRY)),
+    ("huggingface/", (complete_text_hf, 1)),
+)
+STREAMING_PROVIDERS = (get_gpt_output, complete_text_gemini)
 
 def get_llm_output_tools(message,
                    tools=[],
@@ -295,10 +815,35 @@ def get_llm_output_tools(message,
                    temperature=1, 
                    json_object=False,
                    history=None,
-                   return_raw=False
+                   return_raw=False,
+                   seed=None,
+                   stream=False,
+                   thread_id=None,
+                   previous_response_id=None
                    ):
     '''
     A general function to complete a prompt using the specified model.
+
+    When AVATAR_LLM_CACHE=1, identical requests are answered from an in-memory
+    cache. Sampled requests (temperature > 0) are only cached if a fixed `seed`
+    is given; the seed is forwarded to OpenAI models and otherwise only
+    distinguishes cache entries.
+
+    When AVATAR_SEMANTIC_CACHE=1 (requires sentence-transformers), deterministic
+    single-turn requests that miss the exact cache fall back to a nearest-neighbour
+    lookup over previous prompts, returning the stored answer when cosine
+    similarity is at least AVATAR_SEMANTIC_THRESHOLD. Requests with history or
+    prompts longer than the encoder's input length are not semantically cached.
+
+    Concurrent identical requests that are deterministic (temperature == 0 or
+    a fixed `seed`) are deduplicated into a single provider call.
+
+    `stream=True` is supported for OpenAI and Gemini models (see `get_gpt_output`)
+    and raises a ValueError for other providers. Streamed plain-text generators
+    bypass caching and deduplication.
+
+    `thread_id` / `previous_response_id` chain OpenAI turns through the Responses
+    API (see `get_gpt_output`); such stateful requests are never cached.
     '''
     if model not in registered_text_completion_llms:
         warnings.warn(f"Model {model} is not registered. You may still be able to use it.")
@@ -310,17 +855,99 @@ def get_llm_output_tools(message,
               'history': history,
               'tools': tools,
               'return_raw': return_raw}
-    
-    if 'gpt-4' in model:
-        kwargs.update({'max_retry': MAX_OPENAI_RETRY, 'sleep_time': OPENAI_SLEEP_TIME})
-        return get_gpt_output(**kwargs)
-    elif 'claude' in model:
-        kwargs.update({'max_retry': MAX_CLAUDE_RETRY, 'sleep_time': CLAUDE_SLEEP_TIME})
-        return complete_text_claude(**kwargs)
-    elif 'gemma' in model or 'gemini' in model:
-        kwargs.update({'max_retry': MAX_GEMINI_RETRY, 'sleep_time': GEMINI_SLEEP_TIME})
-        return complete_text_gemini(**kwargs)
-    elif 'huggingface' in model:
-        return complete_text_hf(**kwargs)
+
+    provider = next((h for p, h in PROVIDER_TABLE if model.startswith(p)), None)
+    if provider is None:
+        raise ValueError(f"Model {model} not recognized.")
+    handler, max_retry = provider
+    handler_kwargs = {'max_retry': max_retry}
+    if handler is get_gpt_output:
+        handler_kwargs.update({'seed': seed, 'thread_id': thread_id, 'previous_response_id': previous_response_id})
+    elif thread_id is not None or previous_response_id is not None:
+        raise ValueError(f"thread_id/previous_response_id are only supported for OpenAI models, not {model}.")
+    stateful = thread_id is not None or previous_response_id is not None
+
+    if stream:
+        if handler not in STREAMING_PROVIDERS:
+            raise ValueError(f"stream=True is not supported for {model}.")
+        kwargs['stream'] = True
+    if stateful or (stream and not json_object):
+        return handler(**kwargs, **handler_kwargs)
+
+    use_cache = LLM_CACHE_ENABLED and (temperature == 0 or seed is not None)
+    if use_cache:
+        key = _cache_key(seed=seed, **kwargs)
+        result = _cache_lookup(key)
+        if result is not None:
+            return result
+
+    semantic_text = _semantic_prompt(message, history) if SEMANTIC_CACHE_ENABLED and temperature == 0 else None
+    use_semantic_cache = False
+    if semantic_text is not None:
+        semantic_cache = _get_semantic_cache()
+        emb = semantic_cache.embed(semantic_text)
+        use_semantic_cache = emb is not None
+    if use_semantic_cache:
+        scope = _cache_key(**{k: v for k, v in kwargs.items() if k not in ('message', 'history')})
+        result = semantic_cache.lookup(scope, emb)
+        if result is not None:
+            return copy.deepcopy(result)
+
+    def _dispatch():
+        return handler(**kwargs, **handler_kwargs)
+
+    if temperature == 0 or seed is not None:
+        result = _single_flight(_cache_key(seed=seed, **kwargs), _dispatch)
     else:
-        raise ValueError(f"Model {model} not recognized.")
\ No newline at end of file
+        result = _dispatch()
+
+    if use_cache:
+        _cache_update(key, result)
+    if use_semantic_cache:
+        semantic_cache.add(scope, emb, copy.deepcopy(result))
+    return result
+
+
+async def a_get_llm_output_tools(message, executor=None, **kwargs):
+    '''
+    Asynchronous version of `get_llm_output_tools`. The provider call runs in a
+    worker thread of `executor` (the loop's default executor if None) so several
+    requests can wait on the network at once.
+    '''
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(get_llm_output_tools, message, **kwargs))
+
+async def a_batch_get_llm_output_tools(messages, concurrency=LLM_BATCH_CONCURRENCY, return_exceptions=False, **kwargs):
+    '''
+    Complete a list of prompts concurrently, with at most `concurrency` requests
+    in flight. Results are returned in the order of `messages`. With
+    `return_exceptions=True`, a failed prompt yields its exception in place of a
+    result instead of failing the whole batch.
+    '''
+    # A dedicated pool, so the default executor's size does not cap `concurrency`.
+    # It is shut down without waiting: blocking here would freeze the event loop
+    # until every outstanding request finished after one of them failed.
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+    try:
+        return await asyncio.gather(*(a_get_llm_output_tools(message, executor=executor, **kwargs) 
+                                      for message in messages),
+                                    return_exceptions=return_exceptions)
+    finally:
+        executor.shutdown(wait=False)
+
+def batch_get_llm_output_tools(messages, concurrency=LLM_BATCH_CONCURRENCY, return_exceptions=False, **kwargs):
+    '''
+    Synchronous version of `a_batch_get_llm_output_tools`. It uses a thread pool
+    directly rather than `asyncio.run`, so it also works where an event loop is
+    already running (e.g. Jupyter notebooks).
+    '''
+    def _complete(message):
+        try:
+            return get_llm_output_tools(message, **kwargs)
+        except Exception as e:
+            if return_exceptions:
+                return e
+            raise
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(_complete, messages))
@@ -0,0 +1,121 @@
+import re
+from typing import Any, Callable, Iterable, Iterator, Union
+
+import orjson
+
+
+class JSONScanner:
+    """
+    Incrementally locate the first balanced top-level JSON object or array in a
+    stream of text chunks, tracking bracket depth and string/escape state.
+
+    After `feed` returns True, `start` and `end` are the offsets of the value in
+    the concatenated text.
+    """
+    _token = re.compile(r'[{}\[\]"\\]')
+
+    def __init__(self):
+        self.offset = 0
+        self.start = None
+        self.end = None
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+
+    def feed(self, chunk: str) -> bool:
+        """Consume `chunk`; return True once the value is complete."""
+        skip = -1
+        if chunk and self.escape:
+            # The previous chunk ended with a backslash inside a string, so the
+            # first character of this one is escaped
+            self.escape = False
+            skip = 0
+        for match in self._token.finditer(chunk):
+            pos = match.start()
+            if pos == skip:
+                continue
+            ch = match.group()
+            if self.in_string:
+                if ch == '\\':
+                    if pos + 1 < len(chunk):
+                        skip = pos + 1
+                    else:
+                        self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                if self.start is not None:
+                    self.in_string = True
+            elif ch in '{[':
+                if self.start is None:
+                    self.start = self.offset + pos
+                self.depth += 1
+            elif self.start is not None:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.end = self.offset + pos + 1
+                    return True
+        self.offset += len(chunk)
+        return False
+
+
+def extract_json(text: str) -> Any:
+    """
+    Parse a JSON reply. The whole text is tried first; failing that, the first
+    balanced object or array embedded in surrounding text that parses is returned.
+
+    Args:
+        text (str): The model output.
+
+    Returns:
+        Any: The parsed JSON value.
+    """
+    try:
+        return orjson.loads(text.strip())
+    except orjson.JSONDecodeError:
+        pass
+    pos = 0
+    while True:
+        scanner = JSONScanner()
+        if not scanner.feed(text[pos:]):
+            raise ValueError(f"No complete JSON value in response: {text}")
+        try:
+            return orjson.loads(text[pos + scanner.start:pos + scanner.end])
+        except orjson.JSONDecodeError:
+            # Skip past the whole candidate so a nested element is never returned
+            pos += scanner.end
+
+
+def stream_text(chunks: Iterable[str], json_object: bool, close: Callable[[], Any]) -> Union[Iterator[str], Any]:
+    """
+    Turn a stream of text chunks into the function result: a generator of text
+    for plain completions, or the parsed JSON value, returned as soon as it is
+    complete. Reading stops there and `close` is called, which cancels the
+    remaining generation where the provider's stream supports it.
+
+    Args:
+        chunks (Iterable[str]): The streamed text chunks.
+        json_object (bool): Whether to parse the stream as JSON.
+        close (Callable): Called once the stream is no longer read.
+    """
+    if not json_object:
+        def _generate():
+            try:
+                yield from chunks
+            finally:
+                close()
+        return _generate()
+
+    scanner = JSONScanner()
+    buffer = []
+    try:
+        for text in chunks:
+            buffer.append(text)
+            if scanner.feed(text):
+                break
+    finally:
+        close()
+    text = "".join(buffer)
+    if scanner.end is None:
+        raise ValueError(f"No complete JSON value in response: {text}")
+    return orjson.loads(text[scanner.start:scanner.end])
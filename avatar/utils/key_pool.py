@@ -0,0 +1,45 @@
+import threading
+import time
+from typing import Any, List
+
+
+class KeyPool:
+    """
+    A thread-safe round-robin pool of API keys (or clients built from them).
+
+    Items that hit a rate limit can be quarantined for a while; they are skipped
+    until the quarantine expires. If every item is quarantined, the one that is
+    released soonest is returned.
+
+    Args:
+        items (List[Any]): The keys or clients to rotate through.
+    """
+
+    def __init__(self, items: List[Any]):
+        if not items:
+            raise ValueError("KeyPool requires at least one item.")
+        self.items = list(items)
+        self.index = 0
+        self.quarantined_until = [0.0] * len(self.items)
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def next(self) -> Any:
+        with self.lock:
+            now = time.monotonic()
+            for _ in range(len(self.items)):
+                i = self.index
+                self.index = (self.index + 1) % len(self.items)
+                if self.quarantined_until[i] <= now:
+                    return self.items[i]
+            i = min(range(len(self.items)), key=lambda j: self.quarantined_until[j])
+            return self.items[i]
+
+    def quarantine(self, item: Any, seconds: float) -> None:
+        """Skip `item` for the next `seconds` seconds."""
+        with self.lock:
+            for i, candidate in enumerate(self.items):
+                if candidate is item:
+                    self.quarantined_until[i] = time.monotonic() + seconds
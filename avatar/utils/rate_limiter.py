@@ -0,0 +1,49 @@
+import threading
+import time
+
+
+class RateLimiter:
+    """
+    A thread-safe token-bucket limiter on requests per minute and tokens per minute.
+
+    Both buckets start full and refill continuously, so short bursts up to the
+    per-minute budget are allowed while the long-run rate stays within limits.
+
+    Args:
+        rpm (int): The maximum number of requests per minute.
+        tpm (int): The maximum number of tokens per minute.
+    """
+
+    def __init__(self, rpm: int, tpm: int):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = float(rpm)
+        self.tokens = float(tpm)
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self.last_refill
+        self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+        self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+        self.last_refill = now
+
+    def acquire(self, tokens: int = 0) -> None:
+        """
+        Block until one request and `tokens` tokens are available, then consume them.
+
+        Args:
+            tokens (int): The estimated number of tokens the request will use.
+        """
+        tokens = min(tokens, self.tpm)
+        while True:
+            with self.lock:
+                self._refill()
+                if self.requests >= 1 and self.tokens >= tokens:
+                    self.requests -= 1
+                    self.tokens -= tokens
+                    return
+                wait = max((1 - self.requests) * 60 / self.rpm,
+                           (tokens - self.tokens) * 60 / self.tpm)
+            time.sleep(wait)
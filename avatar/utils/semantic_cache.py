@@ -0,0 +1,75 @@
+import threading
+from typing import Any, Dict, List, Optional
+
+import torch
+import torch.nn.functional as F
+
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    SentenceTransformer = None
+
+
+class SemanticCache:
+    """
+    A nearest-neighbour cache that returns a stored completion when a new prompt
+    is close enough (cosine similarity) to a previously answered one.
+
+    Entries are partitioned by `scope`, so prompts sent with different models,
+    tools or decoding settings never share answers.
+
+    Args:
+        model_name (str): The sentence-transformers model used to embed prompts.
+        threshold (float): The minimum cosine similarity for a cache hit.
+    """
+
+    def __init__(self, model_name: str = 'all-MiniLM-L6-v2', threshold: float = 0.92):
+        if SentenceTransformer is None:
+            raise ImportError("sentence-transformers package not installed. "
+                              "Please install it with: pip install sentence-transformers")
+        self.model_name = model_name
+        self.threshold = threshold
+        self.encoder = SentenceTransformer(model_name)
+        self.embs: Dict[str, torch.Tensor] = {}
+        self.values: Dict[str, List[Any]] = {}
+        self.lock = threading.Lock()
+
+    def embed(self, text: str) -> Optional[torch.Tensor]:
+        """
+        Embed `text`, or return None if it is longer than the encoder's maximum
+        input length: truncated prompts that share a prefix would otherwise
+        look identical.
+        """
+        n_tokens = len(self.encoder.tokenizer(text, add_special_tokens=True)["input_ids"])
+        if n_tokens > self.encoder.max_seq_length:
+            return None
+        emb = self.encoder.encode(text, convert_to_tensor=True).float().cpu()
+        return F.normalize(emb.view(1, -1), dim=-1)
+
+    def lookup(self, scope: str, emb: torch.Tensor) -> Optional[Any]:
+        """
+        Return the cached value closest to `emb` within `scope`, or None if no
+        entry reaches the similarity threshold.
+        """
+        with self.lock:
+            if scope not in self.embs:
+                return None
+            sim = torch.matmul(self.embs[scope], emb.T).view(-1)
+            score, idx = sim.max(dim=0)
+            if score.item() < self.threshold:
+                return None
+            return self.values[scope][idx.item()]
+
+    def add(self, scope: str, emb: torch.Tensor, value: Any) -> None:
+        with self.lock:
+            if scope in self.embs:
+                self.embs[scope] = torch.cat([self.embs[scope], emb], dim=0)
+                self.values[scope].append(value)
+            else:
+                self.embs[scope] = emb
+                self.values[scope] = [value]
+
+    def clear(self) -> None:
+        with self.lock:
+            self.embs.clear()
+            self.values.clear()
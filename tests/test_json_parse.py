@@ -0,0 +1,80 @@
+import unittest
+
+from avatar.utils.json_parse import JSONScanner, extract_json, stream_text
+
+
+def scan(chunks):
+    scanner = JSONScanner()
+    for chunk in chunks:
+        if scanner.feed(chunk):
+            return "".join(chunks)[scanner.start:scanner.end]
+    return None
+
+
+class TestJSONScanner(unittest.TestCase):
+
+    def test_object_with_surrounding_text(self):
+        text = 'Sure, here it is: {"a": 1, "b": {"c": [1, 2]}} Hope this helps }'
+        self.assertEqual(scan([text]), '{"a": 1, "b": {"c": [1, 2]}}')
+
+    def test_braces_inside_strings(self):
+        text = '{"a": "}{][", "b": "\\"}"}'
+        self.assertEqual(scan([text]), text)
+
+    def test_top_level_array(self):
+        self.assertEqual(scan(['x [{"a": 1}, {"b": 2}] y']), '[{"a": 1}, {"b": 2}]')
+
+    def test_split_escape(self):
+        chunks = ['{"a": "x', '\\', 'n', '"', ', "b": "}"}']
+        self.assertEqual(scan(chunks), '{"a": "x\\n", "b": "}"}')
+
+    def test_split_escaped_quote(self):
+        chunks = ['{"a": "\\', '"', '}"}']
+        self.assertEqual(scan(chunks), '{"a": "\\"}"}')
+
+    def test_every_split_point(self):
+        text = 'pre {"k": "a\\\\", "l": ["}", "\\"{"]} post'
+        expected = scan([text])
+        for i in range(1, len(text)):
+            self.assertEqual(scan([text[:i], text[i:]]), expected)
+
+    def test_incomplete(self):
+        self.assertIsNone(scan(['{"a": [1, 2']))
+
+
+class TestExtractJSON(unittest.TestCase):
+
+    def test_whole_text(self):
+        self.assertEqual(extract_json(' [{"a":1},{"b":2}] '), [{"a": 1}, {"b": 2}])
+        self.assertEqual(extract_json('[1,2,3]'), [1, 2, 3])
+
+    def test_embedded_object(self):
+        self.assertEqual(extract_json('Answer: {"a": "}"} done'), {"a": "}"})
+
+    def test_skips_invalid_candidate(self):
+        self.assertEqual(extract_json('see [note] then {"a": 1}'), {"a": 1})
+
+    def test_no_json(self):
+        with self.assertRaises(ValueError):
+            extract_json('no json here')
+
+
+class TestStreamText(unittest.TestCase):
+
+    def test_json_stops_reading(self):
+        closed = []
+        chunks = iter(['{"a": "x', '\\', 'n', '"', ', "b": "}"}', ' trailing', ' more'])
+        result = stream_text(chunks, True, lambda: closed.append(True))
+        self.assertEqual(result, {"a": "x\n", "b": "}"})
+        self.assertEqual(closed, [True])
+        self.assertEqual(next(chunks), ' trailing')
+
+    def test_plain_text(self):
+        closed = []
+        result = stream_text(iter(['a', 'b']), False, lambda: closed.append(True))
+        self.assertEqual(list(result), ['a', 'b'])
+        self.assertEqual(closed, [True])
+
+
+if __name__ == '__main__':
+    unittest.main()